@@ -1,71 +1,270 @@
 import os
 import re
-import ast
+import asyncio
+import hashlib
 import logging
-from typing import Dict, Any
-from flask import Flask, request, jsonify
-from dotenv import load_dotenv
-from traceback import format_exc
+import threading
+from types import MappingProxyType, ModuleType
+from typing import Dict, Any, AsyncIterator, Callable, Mapping, Tuple
+import orjson
+from cachetools import TTLCache
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+from dotenv import load_dotenv, dotenv_values
 
 from utils import (
     ocr_process_input,
-    process_conversation_search,
-    retrieve_qa,
-    retrieve_docs_hybrid,
-    retrieve_docs_manual,
-    generate,
+    aprocess_conversation_search,
+    aretrieve_qa,
+    aretrieve_docs_hybrid,
+    aretrieve_docs_manual,
+    agenerate,
+    agenerate_stream,
+    BatchedEmbedder,
+    SemanticCache,
     log_blob,
     log_local,
 )
 
-# Make INFO logs visible (your previous basicConfig dropped INFO)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Root stays at WARNING so third-party SDK loggers stay quiet; our own loggers opt into INFO
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-app = Flask(__name__)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Quart JSON provider that serializes with orjson; types orjson can't handle still go through `default`."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+# Quart cuts streamed bodies off after 60s by default; allow as long as a full generation may take
+app.config['RESPONSE_TIMEOUT'] = 600
 
 load_dotenv('./keys.env')
 
-def load_course_config(course: str) -> None:
+_WS_RE = re.compile(r"\s+")
+_CODE_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+# Final answers keyed by a hash of the exact request body, checked before the embedding is computed
+_EXACT_RESPONSE_CACHE = TTLCache(maxsize=2000, ttl=600)
+_RESPONSE_CACHE_LOCK = threading.RLock()
+_RESPONSE_CACHE_STATS = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0}
+# SQLite file the semantic response cache is saved to and restored from across restarts; unset disables it
+_RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH')
+_RESPONSE_CACHE_SAVE_INTERVAL = 300
+_response_cache_saver = None
+
+QUESTION_KINDS = ('assignment', 'content', 'logistics', 'worksheet')
+
+# Hybrid retrieval per question kind: (index name key, top-k key, semantic reranking)
+HYBRID_CFG = {
+    'content': ('CONTENT_INDEX_NAME', 'CONTENT_INDEX_TOP_K', True),
+    'logistics': ('LOGISTICS_INDEX_NAME', 'LOGISTICS_INDEX_TOP_K', False),
+    'worksheet': ('WORKSHEET_INDEX_NAME', 'WORKSHEET_INDEX_TOP_K', True),
+}
+
+# Final-answer prompt per question kind; assignment questions are drafted and revised separately
+FINAL_PROMPTS = {
+    'content': lambda prompts, conversation, qa_pairs, docs_manual, docs_hybrid: prompts.get_content_prompt(
+        processed_conversation=conversation, retrieved_qa_pairs=qa_pairs, retrieved_docs_hybrid=docs_hybrid),
+    'logistics': lambda prompts, conversation, qa_pairs, docs_manual, docs_hybrid: prompts.get_logistics_prompt(
+        processed_conversation=conversation, retrieved_qa_pairs=qa_pairs, retrieved_docs_hybrid=docs_hybrid),
+    'worksheet': lambda prompts, conversation, qa_pairs, docs_manual, docs_hybrid: prompts.get_worksheet_prompt(
+        processed_conversation=conversation, retrieved_qa_pairs=qa_pairs, retrieved_docs_manual=docs_manual,
+        retrieved_docs_hybrid=docs_hybrid),
+}
+
+# course name -> (prompts module, parsed config), filled on first use of each course; the config is read-only
+# since every request shares it
+_COURSE_CACHE: Dict[str, Tuple[ModuleType, Mapping[str, Any]]] = {}
+_active_course = None
+
+def load_course_config(course: str) -> Tuple[ModuleType, Mapping[str, Any]]:
     try:
-        global prompts
-        if 'ds100' in course:
-            import prompts.ds100_multiturn_prompts as prompts
-            course = 'ds100'
-        elif 'ds8' in course:
-            import prompts.ds8_multiturn_prompts as prompts
-            course = 'ds8'
-        elif 'cs61a' in course:
-            import prompts.cs61a_multiturn_prompts as prompts
-            course = 'cs61a'
-        else:
-            raise ValueError(f"Unsupported course: {course}")
-        load_dotenv(f'configs/{course}.env', override=True)
-        logger.info("load_course_config: loaded prompts and env for %s", course)
+        global _active_course
+        if course not in _COURSE_CACHE:
+            if 'ds100' in course:
+                import prompts.ds100_multiturn_prompts as course_prompts
+                config_name = 'ds100'
+            elif 'ds8' in course:
+                import prompts.ds8_multiturn_prompts as course_prompts
+                config_name = 'ds8'
+            elif 'cs61a' in course:
+                import prompts.cs61a_multiturn_prompts as course_prompts
+                config_name = 'cs61a'
+            else:
+                raise ValueError(f"Unsupported course: {course}")
+            config = {key: val for key, val in dotenv_values(f'configs/{config_name}.env').items() if val is not None}
+            for key in ('ASSIGNMENT_CATEGORIES', 'CONTENT_CATEGORIES', 'LOGISTICS_CATEGORIES', 'WORKSHEET_CATEGORIES'):
+                config[key.lower()] = frozenset(get_env_list(config, key))
+            # Questions in either of these get manual (solution document) retrieval
+            config['manual_retrieval_categories'] = config['assignment_categories'] | config['worksheet_categories']
+            for key in ('CATEGORY_MAPPING', 'SUBCATEGORY_MAPPING'):
+                config[key.lower()] = orjson.loads(config.get(key, '{}'))
+            # category -> kind, with the same precedence the branches used to have (assignment first)
+            config['category_kinds'] = {}
+            for kind in QUESTION_KINDS:
+                for category in config[f'{kind}_categories']:
+                    config['category_kinds'].setdefault(category, kind)
+            config['hybrid'] = {
+                kind: (config.get(index_key), int(config.get(top_k_key, '1')), semantic_reranking)
+                for kind, (index_key, top_k_key, semantic_reranking) in HYBRID_CFG.items()
+            }
+            config['qa_top_k'] = int(config.get('QA_TOP_K', '3'))
+            # HYBRID_FAST=true skips the semantic ranker and keeps the first-stage hybrid ranking
+            config['hybrid_fast'] = config.get('HYBRID_FAST', 'false').strip().lower() == 'true'
+            _COURSE_CACHE[course] = (course_prompts, MappingProxyType(config))
+            logger.info("load_course_config: loaded prompts and env for %s", config_name)
+
+        course_prompts, config = _COURSE_CACHE[course]
+        # utils still reads some settings (QA project, blob container, ...) from the environment
+        if _active_course != course:
+            os.environ.update({key: val for key, val in config.items() if key.isupper()})
+            _active_course = course
+        return course_prompts, config
     except Exception:
-        logger.error("load_course_config failed for course=%s\n%s", course, format_exc())
+        logger.exception("load_course_config failed for course=%s", course)
         raise
 
-def get_env_list(key: str) -> list:
+def get_env_list(env: Dict[str, str], key: str) -> list:
     try:
-        val = os.getenv(key, '[]')
-        lst = ast.literal_eval(val)
+        val = env.get(key, '[]')
+        lst = orjson.loads(val)
         logger.info("get_env_list: %s -> list(len=%s)", key, len(lst) if hasattr(lst, '__len__') else 'n/a')
         return lst
     except Exception:
-        logger.error("get_env_list failed for key=%s (value=%r)\n%s", key, os.getenv(key), format_exc())
+        logger.exception("get_env_list failed for key=%s (value=%r)", key, env.get(key))
+        raise
+
+# The deployed extension serves a single course; parse its config once at import instead of per request
+COURSE = 'ds100_miloh'
+PROMPTS, CONFIG = load_course_config(COURSE)
+# Concurrent requests' cache-key and search embeddings share embeddings calls
+_EMBEDDER = BatchedEmbedder(CONFIG['EMBEDDING_MODEL_NAME'])
+_EMBEDDING_DIMENSIONS = int(CONFIG['EMBEDDING_MODEL_DIMENSIONS'])
+# Retrieval results of recent requests, keyed by the embedding of their search text
+_RETRIEVAL_CACHE = SemanticCache(threshold=0.95, maxsize=10000, ttl=3600, dimensions=_EMBEDDING_DIMENSIONS)
+# Final answers of recent requests, keyed by the embedding of the ticket and chat
+_RESPONSE_CACHE = SemanticCache(threshold=0.92, maxsize=10000, ttl=3600, dimensions=_EMBEDDING_DIMENSIONS)
+
+async def _do_qa(processed_conversation_search: str, top_k: int) -> str:
+    try:
+        retrieved_qa_pairs = await aretrieve_qa(conversation=processed_conversation_search, top_k=top_k)
+        logger.info('Retrieved QA pairs length=%d', len(retrieved_qa_pairs))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Retrieved QA pairs: %s', _brief(retrieved_qa_pairs))
+    except Exception:
+        logger.exception("miloh: retrieve_qa crashed (top_k=%s)", top_k)
         raise
+    return retrieved_qa_pairs
 
-# Global error handler to surface Python tracebacks to logs and client
+async def _do_hybrid(processed_conversation_search: str, kind: str, hybrid_cfg: Tuple[str, int, bool] = None,
+                     search_embedding: list = None, fast: bool = False) -> str:
+    if hybrid_cfg is None:
+        return 'none'
+    idx, top_k, semantic_reranking = hybrid_cfg
+    try:
+        retrieved_docs_hybrid = await aretrieve_docs_hybrid(
+            text=processed_conversation_search,
+            index_name=idx,
+            top_k=top_k,
+            semantic_reranking=semantic_reranking,
+            embedding=search_embedding,
+            fast=fast
+        )
+        logger.info('Hybrid retrieval (%s) index=%r fast=%s', kind, idx, fast)
+        logger.info('Retrieved hybrid documents length=%d', len(retrieved_docs_hybrid))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Retrieved hybrid documents: %s', _brief(retrieved_docs_hybrid))
+    except Exception:
+        logger.exception("miloh: retrieve_docs_hybrid crashed")
+        raise
+    return retrieved_docs_hybrid
+
+async def _do_manual(question_info: str, question_category: str, question_subcategory: str,
+                     category_mapping: dict, subcategory_mapping: dict,
+                     get_prompt: Callable[[str, str], list]) -> tuple:
+    if question_info is None:
+        return 'none', 'none', 'none'
+    try:
+        problem_list_manual, selected_doc_manual, retrieved_docs_manual = await aretrieve_docs_manual(
+            question_category=question_category,
+            category_mapping=category_mapping,
+            question_subcategory=question_subcategory,
+            subcategory_mapping=subcategory_mapping,
+            question_info=question_info,
+            get_prompt=get_prompt)
+    except Exception:
+        logger.exception("miloh: retrieve_docs_manual crashed")
+        raise
+
+    logger.info('Selected manual document: %s (problem list length=%d, document length=%d)',
+                selected_doc_manual, len(problem_list_manual), len(retrieved_docs_manual))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('List of problems: %s', _brief(problem_list_manual))
+        logger.debug('Retrieved manual documents: %s', _brief(retrieved_docs_manual))
+    return problem_list_manual, selected_doc_manual, retrieved_docs_manual
+
+def _brief(obj: Any, limit: int = 512) -> str:
+    # Bounded rendering of possibly large payloads for debug logs
+    text = obj if isinstance(obj, str) else orjson.dumps(obj, default=str).decode()
+    return text if len(text) <= limit else text[:limit] + '...'
+
+async def _sse_events(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    async for chunk in chunks:
+        yield f"data: {orjson.dumps({'Miloh': chunk}).decode()}\n\n"
+    yield "data: [DONE]\n\n"
+
+async def _on_complete(chunks: AsyncIterator[str], callback: Callable[[str], None]) -> AsyncIterator[str]:
+    # Pass chunks through and hand the joined text to callback once the stream is exhausted
+    pieces = []
+    async for chunk in chunks:
+        pieces.append(chunk)
+        yield chunk
+    callback(''.join(pieces))
+
+async def _single(text: str) -> AsyncIterator[str]:
+    yield text
+
+def _exact_cache_key(course: str, input_dict: Dict[str, Any]) -> str:
+    canonical = orjson.dumps([course, input_dict], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(canonical).hexdigest()
+
+def _count_response_cache(outcome: str) -> None:
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE_STATS[outcome] += 1
+
+def _miloh_response(response: str, stream: bool) -> Response:
+    if stream:
+        return Response(_sse_events(_single(response)), mimetype='text/event-stream')
+    return jsonify(Miloh=response)
+
+def _parse_fused_response(fused_response: str) -> Tuple[str, str]:
+    parsed = orjson.loads(_CODE_FENCE_RE.sub('', fused_response))
+    response_0, response = parsed['draft'], parsed['final']
+    if not isinstance(response_0, str) or not isinstance(response, str) or not response.strip():
+        raise ValueError(f"unexpected fused response fields: {list(parsed)}")
+    return response_0, response
+
+# Global error handler to surface Python tracebacks to logs and client; the single place request failures are logged
 @app.errorhandler(Exception)
-def _unhandled(e):
-    logger.error("UNHANDLED %s %s\n%s", request.method, request.path, format_exc())
+async def _unhandled(e):
+    logger.error("UNHANDLED %s %s", request.method, request.path, exc_info=e)
     return jsonify(error="Internal Server Error", detail=str(e)), 500
 
 # Miloh Office Hours Extension
 @app.route('/miloh', methods=['POST'])
-def miloh():
+async def miloh():
     """
     Minimal additional endpoint to handle the new Office Hour extension's JSON:
     {
@@ -75,271 +274,275 @@ def miloh():
       "description": "string",
       "chat": ["string", ...]
     }
-    Calls the LLM and returns the response.
+    Calls the LLM and returns the response. The response is streamed as server-sent events instead when the
+    client accepts text/event-stream (e.g. EventSource) or passes ?stream=1; ?stream=0 always returns JSON.
     """
+    if request.headers.get('Authorization') != os.getenv('API_KEY'):
+        logger.warning('Unauthorized access attempt (Authorization header present: %s)',
+                       'yes' if request.headers.get('Authorization') else 'no')
+        return jsonify(error='Unauthorized'), 401
+
+    # Get input data
+    input_dict = app.json.loads(await request.get_data() or b'{}') or {}
+    if not isinstance(input_dict, dict):
+        return jsonify(error='Request body must be a JSON object'), 400
+    logger.info('Received input keys: %s', list(input_dict.keys()))
+    # Stream the final answer as server-sent events while it is being generated, unless the client only takes JSON
+    stream_arg = request.args.get('stream')
+    stream = stream_arg == '1' or (
+        stream_arg != '0'
+        and request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream')
+
+    # Put the main ticket info (assignment, question, description)
+    # as the first "student" turn:
+    initial_text = f"Assignment: {input_dict.get('assignment','')}\n" \
+                   f"Question: {input_dict.get('question','')}\n" \
+                   f"Description: {input_dict.get('description','')}"
+    # Chat messages as text, without blank ones; used for both the cache key and the conversation
+    chat = [text for text in map(str, input_dict.get('chat', ())) if text.strip()]
+
+    # Retries and refreshes resend the identical body
+    exact_key = _exact_cache_key(COURSE, input_dict)
+    with _RESPONSE_CACHE_LOCK:
+        cached_response = _EXACT_RESPONSE_CACHE.get(exact_key)
+    if cached_response is not None:
+        logger.info('Response cache hit (exact)')
+        _count_response_cache('exact_hits')
+        return _miloh_response(cached_response, stream)
+
+    # A ticket that reads like a recent one about the same problem gets the same answer, skipping everything below.
+    # The turn count and latest message are part of the namespace, so a follow-up turn never matches an earlier turn
+    # of its own thread; only rewordings of the same turn are compared.
+    latest_chat_digest = hashlib.blake2b(chat[-1].encode(), digest_size=16).hexdigest() if chat else ''
+    response_namespace = (COURSE, input_dict.get('assignment', ''), input_dict.get('question', ''),
+                          len(chat), latest_chat_digest)
+    request_embedding = cached_response = None
+    try:
+        request_embedding = await _EMBEDDER.embed("\n".join([initial_text, *chat]))
+        cached_response = _RESPONSE_CACHE.get(request_embedding, namespace=response_namespace)
+    except Exception:
+        logger.exception("miloh: response cache lookup failed, answering without cache")
+    logger.info('Response cache %s', 'hit (semantic)' if cached_response is not None else 'miss')
+    if cached_response is not None:
+        _count_response_cache('semantic_hits')
+        with _RESPONSE_CACHE_LOCK:
+            _EXACT_RESPONSE_CACHE[exact_key] = cached_response
+        return _miloh_response(cached_response, stream)
+    _count_response_cache('misses')
+
+    def cache_response(text: str) -> None:
+        if not text.strip():
+            return
+        with _RESPONSE_CACHE_LOCK:
+            _EXACT_RESPONSE_CACHE[exact_key] = text
+        if request_embedding is not None:
+            try:
+                _RESPONSE_CACHE.put(request_embedding, text, namespace=response_namespace)
+            except Exception:
+                logger.exception("miloh: storing the response in the cache failed")
+
+    # Construct Ed-like payload: the ticket is the first "student" turn (no images, so no OCR needed),
+    # followed by each non-blank chat message as another "student" turn
+    conversation_history = [
+        {"user_role": "student", "text": initial_text, "document": None},
+        *({"user_role": "student", "text": c, "document": None} for c in chat),
+    ]
+
+    # For thread_title, combine assignment + question:
+    thread_title = f"{input_dict.get('assignment','')} — {input_dict.get('question','')}"
+    processed_conversation = ocr_process_input(
+        thread_title=thread_title,
+        conversation_history=conversation_history,
+    )
+    logger.info("Processed conversation length: %s", len(processed_conversation) if processed_conversation else 0)
+
+    question_category = 'Homeworks'
+    kind = CONFIG['category_kinds'].get(question_category)
+    logger.info("Question category: %s (kind=%s)", question_category, kind)
+
+    question_info = None
+    if question_category in CONFIG['manual_retrieval_categories']:
+        parts = [question_category,
+                 input_dict.get('assignment') or '',
+                 input_dict.get('question') or '',
+                 input_dict.get('description') or '']
+        # Longer threads also include the opening turn; the latest turn is indexed once either way
+        if len(processed_conversation) > 2:
+            parts.append(processed_conversation[0]['text'])
+        parts.append(processed_conversation[-1]['text'])
+        # Ticket fields aren't guaranteed to be strings (numbers, booleans, ...)
+        question_info = _WS_RE.sub(" ", " ".join(map(str, parts)))
+
+    # Manual retrieval only needs question_info, so start it while the conversation is being summarized
+    manual_task = asyncio.ensure_future(
+        _do_manual(question_info, question_category, input_dict.get('subcategory'),
+                   CONFIG['category_mapping'], CONFIG['subcategory_mapping'],
+                   PROMPTS.get_choose_problem_path_prompt))
+
     try:
-        if request.headers.get('Authorization') != os.getenv('API_KEY'):
-            logger.warning('Unauthorized access attempt (Authorization header present: %s)',
-                           'yes' if request.headers.get('Authorization') else 'no')
-            return jsonify(error='Unauthorized'), 401
+        # Only earlier turns are summarized, so a single-turn ticket needs no summarization prompt
+        processed_conversation_search = await aprocess_conversation_search(
+            processed_conversation=processed_conversation,
+            prompt_summarize=(PROMPTS.get_summarize_conversation_prompt(processed_conversation[:-1])
+                              if len(processed_conversation) > 1 else None)
+        )
+        logger.info('Processed (summarized) conversation for search length=%d', len(processed_conversation_search))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Processed (summarized) conversation for search: %s', _brief(processed_conversation_search))
+    except Exception:
+        # The error handler logs the failure; just don't leave the speculative retrieval running
+        manual_task.cancel()
+        raise
 
-        # Get input data and load the course config
-        try:
-            input_dict = request.json or {}
-        except Exception:
-            logger.error("Failed to parse JSON body\n%s", format_exc())
-            raise
-        logger.info('Received input keys: %s', list(input_dict.keys()))
+    # Near-duplicate questions about the same problem reuse earlier retrieval results
+    cache_namespace = (COURSE, question_category, input_dict.get('assignment', ''), input_dict.get('question', ''))
+    search_embedding = cached_retrieval = None
+    try:
+        search_embedding = await _EMBEDDER.embed(processed_conversation_search)
+        cached_retrieval = _RETRIEVAL_CACHE.get(search_embedding, namespace=cache_namespace)
+    except Exception:
+        logger.exception("miloh: retrieval cache lookup failed, retrieving without cache")
+    logger.info('Retrieval cache %s', 'hit' if cached_retrieval is not None else 'miss')
 
-        course = 'ds100_miloh'
-        try:
-            load_course_config('ds100_miloh')
-        except Exception:
-            logger.error("miloh: load_course_config crashed\n%s", format_exc())
-            raise
+    if cached_retrieval is not None:
+        manual_task.cancel()
+        retrieved_qa_pairs, retrieved_docs_hybrid, (problem_list_manual, selected_doc_manual, retrieved_docs_manual) = \
+            cached_retrieval
+    else:
+        # The three retrievals are independent network calls, so run them concurrently. Each one logs its own
+        # failure; wait for all of them so a failed retrieval doesn't leave the others running unobserved.
+        results = await asyncio.gather(
+            _do_qa(processed_conversation_search, CONFIG['qa_top_k']),
+            _do_hybrid(processed_conversation_search, kind, CONFIG['hybrid'].get(kind), search_embedding,
+                       CONFIG['hybrid_fast']),
+            manual_task,
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        retrieved_qa_pairs, retrieved_docs_hybrid, (problem_list_manual, selected_doc_manual, retrieved_docs_manual) = \
+            results
+        # retrieve_docs_hybrid returns '' and retrieve_docs_manual 'none (error)' on failure; don't cache those
+        if search_embedding is not None and retrieved_docs_hybrid != '' and retrieved_docs_manual != 'none (error)':
+            try:
+                _RETRIEVAL_CACHE.put(
+                    search_embedding,
+                    (retrieved_qa_pairs, retrieved_docs_hybrid, (problem_list_manual, selected_doc_manual, retrieved_docs_manual)),
+                    namespace=cache_namespace)
+            except Exception:
+                logger.exception("miloh: storing the retrieval results in the cache failed")
 
+    # Response generation
+    response_0 = response = ''
+    final_prompt = None
+    if kind == 'assignment' and not stream:
+        # Draft and revise in a single LLM call; fall back to two calls if the output isn't the expected JSON
+        fused_response = await agenerate(
+            prompt=PROMPTS.get_fused_assignment_prompt(
+                processed_conversation=processed_conversation,
+                retrieved_qa_pairs=retrieved_qa_pairs,
+                retrieved_docs_manual=retrieved_docs_manual
+            ),
+            response_format={"type": "json_object"}
+        )
         try:
-            assignment_categories = get_env_list('ASSIGNMENT_CATEGORIES')
-            content_categories = get_env_list('CONTENT_CATEGORIES')
-            logistics_categories = get_env_list('LOGISTICS_CATEGORIES')
-            worksheet_categories = get_env_list('WORKSHEET_CATEGORIES')
-        except Exception:
-            logger.error("miloh: loading env category lists crashed\n%s", format_exc())
-            raise
-
-        # Construct Ed-like payload
-        conversation_history = []
-
-        # Put the main ticket info (assignment, question, description)
-        # as the first "student" turn:
-        initial_text = f"Assignment: {input_dict.get('assignment','')}\n" \
-                       f"Question: {input_dict.get('question','')}\n" \
-                       f"Description: {input_dict.get('description','')}"
-
-        conversation_history.append({
-            "user_role": "student",      # treat this entire first chunk as "student" text
-            "text": initial_text,
-            "document": None              # No images (so no OCR needed)
-        })
-
-        # Then put each chat message as additional "student" turns
-        try:
-            for c in input_dict.get('chat', []):
-                conversation_history.append({
-                    "user_role": "student",
-                    "text": c,
-                    "document": None
-                })
-        except Exception:
-            logger.error("miloh: building conversation_history crashed\n%s", format_exc())
-            raise
-
-        # For thread_title, combine assignment + question:
-        thread_title = f"{input_dict.get('assignment','')} — {input_dict.get('question','')}"
-        try:
-            processed_conversation = ocr_process_input(
-                thread_title=thread_title,
-                conversation_history=conversation_history,
-            )
-            logger.info("Processed conversation length: %s", len(processed_conversation) if processed_conversation else 0)
-        except Exception:
-            logger.error("miloh: ocr_process_input crashed (thread_title=%r)\n%s", thread_title, format_exc())
-            raise
+            response_0, response = _parse_fused_response(fused_response)
+            logger.info('Initial response (assignment question) length=%s', len(response_0 or ''))
+        except (ValueError, KeyError, TypeError):
+            logger.warning("miloh: could not parse fused assignment response, falling back to two calls", exc_info=True)
 
-        try:
-            processed_conversation_search = process_conversation_search(
+    if kind == 'assignment' and not response:
+        # The first answer is only an input to the second prompt, so it is never streamed
+        response_0 = await agenerate(
+            prompt=PROMPTS.get_first_assignment_prompt(
                 processed_conversation=processed_conversation,
-                prompt_summarize=prompts.get_summarize_conversation_prompt(processed_conversation[:-1])
+                retrieved_qa_pairs=retrieved_qa_pairs,
+                retrieved_docs_manual=retrieved_docs_manual
             )
-            logger.info('Processed (summarized) conversation for search: %s',
-                        (processed_conversation_search[:200] + '...') if isinstance(processed_conversation_search, str) and len(processed_conversation_search) > 200 else processed_conversation_search)
-        except Exception:
-            logger.error("miloh: process_conversation_search crashed\n%s", format_exc())
-            raise
+        )
+        logger.info('Initial response (assignment question) length=%s', len(response_0 or ''))
 
-        # QA retrieval
-        try:
-            top_k = int(os.getenv('QA_TOP_K', '3'))
-        except Exception:
-            logger.error("miloh: invalid QA_TOP_K=%r\n%s", os.getenv('QA_TOP_K'), format_exc())
-            raise
+        final_prompt = PROMPTS.get_second_assignment_prompt(
+            processed_conversation=processed_conversation,
+            first_answer=response_0
+        )
+    elif kind in FINAL_PROMPTS:
+        final_prompt = FINAL_PROMPTS[kind](PROMPTS, processed_conversation, retrieved_qa_pairs,
+                                           retrieved_docs_manual, retrieved_docs_hybrid)
+
+    if final_prompt is not None:
+        if stream:
+            logger.info('Streaming final response (category=%s)', question_category)
+            return Response(_sse_events(_on_complete(agenerate_stream(prompt=final_prompt), cache_response)),
+                            mimetype='text/event-stream')
+        response = await agenerate(prompt=final_prompt)
+    logger.info('Final response length=%s', len(response or ''))
+
+    # Logging and posting (no logic change)
+    output_dict = {
+        'processed_conversation': processed_conversation,
+        'processed_conversation_search': processed_conversation_search,
+        'retrieved_qa_pairs': retrieved_qa_pairs,
+        'retrieved_docs_hybrid': retrieved_docs_hybrid,
+        'problem_list_manual': problem_list_manual,
+        'selected_doc_manual': selected_doc_manual,
+        'retrieved_docs_manual': retrieved_docs_manual,
+        'response_0': response_0,
+        'response': response
+    }
+
+    cache_response(response)
+    return _miloh_response(output_dict["response"], stream)
 
-        try:
-            retrieved_qa_pairs = retrieve_qa(conversation=processed_conversation_search, top_k=top_k)
-            logger.info('Retrieved QA pairs type=%s', type(retrieved_qa_pairs).__name__)
-        except Exception:
-            logger.error("miloh: retrieve_qa crashed (top_k=%s)\n%s", top_k, format_exc())
-            raise
-
-        question_category = 'Homeworks'
-        logger.info("Question category: %s (in assignment=%s, content=%s, logistics=%s, worksheet=%s)",
-                    question_category,
-                    question_category in assignment_categories,
-                    question_category in content_categories,
-                    question_category in logistics_categories,
-                    question_category in worksheet_categories)
-
-        # Hybrid document retrieval
-        retrieved_docs_hybrid = 'none'
-        try:
-            if question_category in content_categories:
-                idx = os.getenv('CONTENT_INDEX_NAME')
-                retrieved_docs_hybrid = retrieve_docs_hybrid(
-                    text=processed_conversation_search,
-                    index_name=idx,
-                    top_k=int(os.getenv('CONTENT_INDEX_TOP_K', '1')),
-                    semantic_reranking=True
-                )
-                logger.info('Hybrid retrieval (content) index=%r', idx)
-            elif question_category in logistics_categories:
-                idx = os.getenv('LOGISTICS_INDEX_NAME')
-                retrieved_docs_hybrid = retrieve_docs_hybrid(
-                    text=processed_conversation_search,
-                    index_name=idx,
-                    top_k=int(os.getenv('LOGISTICS_INDEX_TOP_K', '1')),
-                    semantic_reranking=False
-                )
-                logger.info('Hybrid retrieval (logistics) index=%r', idx)
-            elif question_category in worksheet_categories:
-                idx = os.getenv('WORKSHEET_INDEX_NAME')
-                retrieved_docs_hybrid = retrieve_docs_hybrid(
-                    text=processed_conversation_search,
-                    index_name=idx,
-                    top_k=int(os.getenv('WORKSHEET_INDEX_TOP_K', '1')),
-                    semantic_reranking=True
-                )
-                logger.info('Hybrid retrieval (worksheet) index=%r', idx)
-            logger.info('Retrieved hybrid documents type=%s', type(retrieved_docs_hybrid).__name__)
-        except Exception:
-            logger.error("miloh: retrieve_docs_hybrid crashed\n%s", format_exc())
-            raise
-
-        # Manual document retrieval
-        problem_list_manual = selected_doc_manual = retrieved_docs_manual = 'none'
-        try:
-            if question_category in (assignment_categories + worksheet_categories):
-                try:
-                    question_info = re.sub(
-                        r"\n+",
-                        " ",
-                        f"{question_category} "
-                        f"{input_dict.get('assignment', '')} "
-                        f"{input_dict.get('question', '')} "
-                        f"{input_dict.get('description', '')} "
-                        f"{processed_conversation[-1]['text'] if len(processed_conversation) <= 2 else processed_conversation[0]['text'] + processed_conversation[-1]['text']}"
-                    )
-                except Exception:
-                    logger.error("miloh: building question_info crashed\n%s", format_exc())
-                    raise
-
-                try:
-                    problem_list_manual, selected_doc_manual, retrieved_docs_manual = retrieve_docs_manual(
-                        question_category=question_category,
-                        category_mapping=ast.literal_eval(os.getenv('CATEGORY_MAPPING', '{}')),
-                        question_subcategory=input_dict.get('subcategory'),
-                        subcategory_mapping=ast.literal_eval(os.getenv('SUBCATEGORY_MAPPING', '{}')),
-                        question_info=question_info,
-                        get_prompt=prompts.get_choose_problem_path_prompt)
-                except Exception:
-                    logger.error("miloh: retrieve_docs_manual crashed\n%s", format_exc())
-                    raise
-
-                logger.info('List of problems: %s', problem_list_manual)
-                logger.info('Selected manual document: %s', selected_doc_manual)
-                logger.info('Retrieved manual documents: %s', retrieved_docs_manual)
-        except Exception:
-            logger.error("miloh: manual retrieval block crashed\n%s", format_exc())
-            raise
-
-        # Response generation
-        try:
-            response_0 = response = ''
-            if question_category in assignment_categories:
-                try:
-                    response_0 = generate(
-                        prompt=prompts.get_first_assignment_prompt(
-                            processed_conversation=processed_conversation,
-                            retrieved_qa_pairs=retrieved_qa_pairs,
-                            retrieved_docs_manual=retrieved_docs_manual
-                        )
-                    )
-                    logger.info('Initial response (assignment question) length=%s', len(response_0 or ''))
-                except Exception:
-                    logger.error("miloh: first assignment generate crashed\n%s", format_exc())
-                    raise
-
-                try:
-                    response = generate(
-                        prompt=prompts.get_second_assignment_prompt(
-                            processed_conversation=processed_conversation,
-                            first_answer=response_0
-                        )
-                    )
-                except Exception:
-                    logger.error("miloh: second assignment generate crashed\n%s", format_exc())
-                    raise
-            elif question_category in content_categories:
-                try:
-                    response = generate(
-                        prompt=prompts.get_content_prompt(
-                            processed_conversation=processed_conversation,
-                            retrieved_qa_pairs=retrieved_qa_pairs,
-                            retrieved_docs_hybrid=retrieved_docs_hybrid
-                        )
-                    )
-                except Exception:
-                    logger.error("miloh: content generate crashed\n%s", format_exc())
-                    raise
-            elif question_category in logistics_categories:
-                try:
-                    response = generate(
-                        prompt=prompts.get_logistics_prompt(
-                            processed_conversation=processed_conversation,
-                            retrieved_qa_pairs=retrieved_qa_pairs,
-                            retrieved_docs_hybrid=retrieved_docs_hybrid
-                        )
-                    )
-                except Exception:
-                    logger.error("miloh: logistics generate crashed\n%s", format_exc())
-                    raise
-            elif question_category in worksheet_categories:
-                try:
-                    response = generate(
-                        prompt=prompts.get_worksheet_prompt(
-                            processed_conversation=processed_conversation,
-                            retrieved_qa_pairs=retrieved_qa_pairs,
-                            retrieved_docs_manual=retrieved_docs_manual,
-                            retrieved_docs_hybrid=retrieved_docs_hybrid
-                        )
-                    )
-                except Exception:
-                    logger.error("miloh: worksheet generate crashed\n%s", format_exc())
-                    raise
-            logger.info('Final response length=%s', len(response or ''))
-        except Exception:
-            logger.error("miloh: response generation block crashed\n%s", format_exc())
-            raise
-
-        # Logging and posting (no logic change)
-        output_dict = {
-            'processed_conversation': processed_conversation,
-            'processed_conversation_search': processed_conversation_search,
-            'retrieved_qa_pairs': retrieved_qa_pairs,
-            'retrieved_docs_hybrid': retrieved_docs_hybrid,
-            'problem_list_manual': problem_list_manual,
-            'selected_doc_manual': selected_doc_manual,
-            'retrieved_docs_manual': retrieved_docs_manual,
-            'response_0': response_0,
-            'response': response
-        }
-
-        return jsonify({"Miloh": output_dict["response"]})
 
+@app.route('/miloh/cache_stats', methods=['GET'])
+async def miloh_cache_stats():
+    """
+    Hit/miss counters of the /miloh response caches since the worker started:
+    {"exact_hits": int, "semantic_hits": int, "misses": int, "hit_rate": float, "exact_size": int}
+    """
+    if request.headers.get('Authorization') != os.getenv('API_KEY'):
+        return jsonify(error='Unauthorized'), 401
+    with _RESPONSE_CACHE_LOCK:
+        stats = dict(_RESPONSE_CACHE_STATS, exact_size=len(_EXACT_RESPONSE_CACHE))
+    lookups = stats['exact_hits'] + stats['semantic_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['exact_hits'] + stats['semantic_hits']) / lookups if lookups else 0.0
+    return jsonify(stats)
+
+
+async def _save_response_cache() -> None:
+    try:
+        saved = await asyncio.to_thread(_RESPONSE_CACHE.save, _RESPONSE_CACHE_PATH)
+        logger.info('Saved %d response cache entries to %s', saved, _RESPONSE_CACHE_PATH)
     except Exception:
-        # This catches anything missed above; global handler will also log.
-        logger.error("miloh: unhandled exception at top level\n%s", format_exc())
-        raise
+        logger.exception("Saving the response cache to %s failed", _RESPONSE_CACHE_PATH)
+
+async def _save_response_cache_periodically() -> None:
+    while True:
+        await asyncio.sleep(_RESPONSE_CACHE_SAVE_INTERVAL)
+        await _save_response_cache()
+
+@app.before_serving
+async def _restore_response_cache():
+    global _response_cache_saver
+    if not _RESPONSE_CACHE_PATH:
+        return
+    try:
+        loaded = await asyncio.to_thread(_RESPONSE_CACHE.load, _RESPONSE_CACHE_PATH)
+        logger.info('Loaded %d response cache entries from %s', loaded, _RESPONSE_CACHE_PATH)
+    except Exception:
+        logger.exception("Loading the response cache from %s failed, starting empty", _RESPONSE_CACHE_PATH)
+    _response_cache_saver = asyncio.create_task(_save_response_cache_periodically())
+
+@app.after_serving
+async def _persist_response_cache():
+    if _response_cache_saver is None:
+        return
+    _response_cache_saver.cancel()
+    await _save_response_cache()
 
 
+# Local debugging only; deployments run `gunicorn app:app` with uvicorn workers (see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,20 @@
+import os
+from multiprocessing import cpu_count
+
+# Picked up automatically by `gunicorn app:app` (Azure App Service's default startup command).
+# app is a Quart (ASGI) app, so each worker is a uvicorn event loop (uvloop when installed) that multiplexes
+# many in-flight /miloh requests; their blocking SDK calls run on utils' shared thread pool.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# One event loop per core is enough for I/O-bound requests. Each worker has its own outbound-call limit
+# (utils._OUTBOUND_LIMIT) and its own response/retrieval caches, so more workers raise the total number of
+# concurrent service calls and split the caches' hit rate.
+workers = int(os.getenv('GUNICORN_WORKERS', cpu_count()))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Generation plus retrieval can take well over gunicorn's 30s default
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '600'))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'warning')
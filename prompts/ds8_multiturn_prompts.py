@@ -87,6 +87,13 @@ I'd recheck your thought process for getting movies with a rating above 8.
 I hope this hint was helpful. Feel free to follow up if you have further questions!"""
 
 
+assignment_1_prompt = [
+    {"role": "system", "content": assignment_1_system_prompt},
+    {"role": "user", "content": assignment_1_few_shot_1_user},
+    {"role": "assistant", "content": assignment_1_few_shot_1_assistant},
+]
+
+
 def get_first_assignment_prompt(processed_conversation: str, retrieved_qa_pairs: str,
                                 retrieved_docs_manual: str) -> list:
     curr_prompt = f"""Here are the relevant excerpts from the assignment solutions to guide your response:
@@ -104,12 +111,7 @@ def get_first_assignment_prompt(processed_conversation: str, retrieved_qa_pairs:
     {processed_conversation}
     ==========================================
     Given the conversation between the student and the TA, answer the most recent student question concisely based on the provided assignment solutions and historical question-answer pairs. Do not repeat what has already been said. Do not give away or directly refer to the solutions."""
-    return [
-        {"role": "system", "content": assignment_1_system_prompt},
-        {"role": "user", "content": assignment_1_few_shot_1_user},
-        {"role": "assistant", "content": assignment_1_few_shot_1_assistant},
-        {"role": "user", "content": curr_prompt}
-    ]
+    return assignment_1_prompt + [{"role": "user", "content": curr_prompt}]
 
 
 assingment_2_system_prompt = """Given a student's question and a potential answer, please modify the answer according to the following guidelines:
@@ -135,6 +137,13 @@ assignment_2_few_shot_1_assistant = """Hi! It seems there might be a misundersta
 Feel free to follow up if you have further questions!"""
 
 
+assignment_2_prompt = [
+    {"role": "system", "content": assingment_2_system_prompt},
+    # {"role": "user", "content": assignment_2_few_shot_1_user},
+    # {"role": "assistant", "content": assignment_2_few_shot_1_assistant},
+]
+
+
 def get_second_assignment_prompt(processed_conversation: str, first_answer: str) -> list:
     curr_prompt = f"""Conversation History and Student question:
     ==========================================
@@ -145,12 +154,23 @@ def get_second_assignment_prompt(processed_conversation: str, first_answer: str)
     ==========================================
     {first_answer}
     =========================================="""
-    return [
-        {"role": "system", "content": assingment_2_system_prompt},
-        # {"role": "user", "content": assignment_2_few_shot_1_user},
-        # {"role": "assistant", "content": assignment_2_few_shot_1_assistant},
-        {"role": "user", "content": curr_prompt}
-    ]
+    return assignment_2_prompt + [{"role": "user", "content": curr_prompt}]
+
+
+fused_assignment_instructions = """Then, revise your answer according to the following guidelines:
+1. Revise the answer to make it more concise.
+2. Remove any solutions provided in the original answer, leaving only hints and guiding explanations.
+3. Encourage the student to ask follow-up questions if they need further clarification.
+Format the output as a JSON object as follows: {"draft": "your answer before revision", "final": "your revised answer"}, do not include any other formatting."""
+
+
+def get_fused_assignment_prompt(processed_conversation: str, retrieved_qa_pairs: str,
+                                retrieved_docs_manual: str) -> list:
+    prompt = get_first_assignment_prompt(processed_conversation=processed_conversation,
+                                         retrieved_qa_pairs=retrieved_qa_pairs,
+                                         retrieved_docs_manual=retrieved_docs_manual)
+    prompt[-1] = {"role": "user", "content": f"{prompt[-1]['content']}\n\n{fused_assignment_instructions}"}
+    return prompt
 
 
 content_system_prompt = """
@@ -235,6 +255,13 @@ For example, doing tbl.sort("Column 1").sort("Column 2") is completely valid bec
 Keep in mind though that the second (latter) sort on Column 2 can mess up and rearrange your already sorted Column 1!
 I hope this helps clarify the differences! Let me know if you have any more questions."""
 
+content_prompt = [
+    {"role": "system", "content": content_system_prompt},
+    {"role": "user", "content": content_few_shot_1_user},
+    {"role": "assistant", "content": content_few_shot_1_assistant},
+]
+
+
 def get_content_prompt(processed_conversation: str, retrieved_qa_pairs: str, retrieved_docs_hybrid: str) -> list:
     curr_prompt = f"""Here are the excerpts from the course notes to guide your response:
     ==========================================
@@ -251,12 +278,7 @@ def get_content_prompt(processed_conversation: str, retrieved_qa_pairs: str, ret
     {processed_conversation}
     ==========================================
     Given the conversation between the student and the TA, answer the most recent student question concisely based on the provided course notes and historical question-answer pairs. Do not repeat what has already been said."""
-    return [
-        {"role": "system", "content": content_system_prompt},
-        {"role": "user", "content": content_few_shot_1_user},
-        {"role": "assistant", "content": content_few_shot_1_assistant},
-        {"role": "user", "content": curr_prompt}
-    ]
+    return content_prompt + [{"role": "user", "content": curr_prompt}]
 
 
 logistics_system_prompt = """
@@ -324,6 +346,15 @@ Given the conversation between the student and the TA, answer the most recent st
 logistics_few_shot_2_assistant = """Please submit the autograder regrade request form, and we will get back to you as soon as possible."""
 
 
+logistics_prompt = [
+    {"role": "system", "content": logistics_system_prompt},
+    {"role": "user", "content": logistics_few_shot_1_user},
+    {"role": "assistant", "content": logistics_few_shot_1_assistant},
+    {"role": "user", "content": logistics_few_shot_2_user},
+    {"role": "assistant", "content": logistics_few_shot_2_assistant},
+]
+
+
 def get_logistics_prompt(processed_conversation: str, retrieved_qa_pairs: str, retrieved_docs_hybrid: str) -> list:
     curr_prompt = f"""Here are the excerpts from the course syllabus to guide your response:
     ==========================================
@@ -340,14 +371,7 @@ def get_logistics_prompt(processed_conversation: str, retrieved_qa_pairs: str, r
     {processed_conversation}
     ==========================================
     Given the conversation between the student and the TA, answer the most recent student question concisely based on the provided syllabus sections and historical question-answer pairs. Do not repeat what has already been said."""
-    return [
-        {"role": "system", "content": logistics_system_prompt},
-        {"role": "user", "content": logistics_few_shot_1_user},
-        {"role": "assistant", "content": logistics_few_shot_1_assistant},
-        {"role": "user", "content": logistics_few_shot_2_user},
-        {"role": "assistant", "content": logistics_few_shot_2_assistant},
-        {"role": "user", "content": curr_prompt}
-    ]
+    return logistics_prompt + [{"role": "user", "content": curr_prompt}]
 
 
 worksheet_system_prompt = """You will simulate the role of a teaching assistant for an undergraduate data science course, answering student questions on discussion worksheet and past exam questions based on the provided excerpts from the worksheet solutions, course notes, and historical question-answer pairs.
@@ -410,6 +434,13 @@ For A/B Testing, the null hypothesis is typically a statement about two sets of
 In both scenarios, we actually resample from our sample data for the purposes of understanding variability. Neither scenario involves going out to the population and getting new data. Bootstrapping aims to understand the variability of an estimate (such as sample average) so that we can make a confidence interval about a population parameter (such as the population average); A/B testing aims to understand the variability of a test statistic (such as difference of means) so that we can determine how strange our observed test statistic is relative to what could happen if the null is true."""
 
 
+worksheet_prompt = [
+    {"role": "system", "content": worksheet_system_prompt},
+    {"role": "user", "content": worksheet_few_shot_1_user},
+    {"role": "assistant", "content": worksheet_few_shot_1_assistant},
+]
+
+
 def get_worksheet_prompt(processed_conversation: str, retrieved_qa_pairs: str, retrieved_docs_manual: str,
                          retrieved_docs_hybrid: str) -> list:
     curr_prompt = f"""Here are the excerpts from the course notes to guide your response:
@@ -432,9 +463,4 @@ def get_worksheet_prompt(processed_conversation: str, retrieved_qa_pairs: str, r
     {processed_conversation}
     ==========================================
     Given the conversation between the student and the TA, answer the most recent student question concisely based on the provided solutions, course notes, and historical question-answer pairs. Do not repeat what has already been said. Do not give away the solution, only provide hints and explanations."""
-    return [
-        {"role": "system", "content": worksheet_system_prompt},
-        {"role": "user", "content": worksheet_few_shot_1_user},
-        {"role": "assistant", "content": worksheet_few_shot_1_assistant},
-        {"role": "user", "content": curr_prompt}
-    ]
\ No newline at end of file
+    return worksheet_prompt + [{"role": "user", "content": curr_prompt}]
\ No newline at end of file
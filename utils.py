@@ -4,27 +4,85 @@ import ast
 import html
 import time
 import json
+import sqlite3
+import hashlib
+import asyncio
+import functools
 import logging
+import threading
 from pathlib import Path
-from typing import List, Dict, Any, Callable
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator
 from datetime import datetime
 from xml.etree import ElementTree as ET
 
-import requests
+import httpx
+import numpy as np
+import orjson
+from cachetools import LRUCache, TTLCache
 from azure.cognitiveservices.vision.computervision import ComputerVisionClient
 from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes
 from msrest.authentication import CognitiveServicesCredentials
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.language.questionanswering import QuestionAnsweringClient
 from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContainerClient
 from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
 
-logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+_NL_RE = re.compile(r"\n+")
+
+# Caps the number of blocking SDK/HTTP calls in flight across all requests of this process, to stay within service
+# rate limits; every server worker process has its own. It is awaited on the event loop before work is handed to the
+# executor, so pool threads never sit blocked waiting for a slot.
+_OUTBOUND_LIMIT = asyncio.Semaphore(8)
+# Worker threads for the async variants below, shared by all requests
+_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix='utils-io')
+
+# LLM completions of recent prompts, keyed by a digest of the request payload
+_GENERATE_CACHE = LRUCache(maxsize=2048)
+_GENERATE_CACHE_LOCK = threading.Lock()
+# Embeddings of recent texts, keyed by model and text
+_EMBED_CACHE = LRUCache(maxsize=1024)
+_EMBED_CACHE_LOCK = threading.Lock()
+
+# Pooled keep-alive HTTP/2 client for the LLM endpoint, so calls reuse connections instead of a new TLS handshake each time
+_HTTP = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(120, connect=10),
+)
+
+
+# The Azure SDK clients below are thread-safe and pool their connections, so one instance per configuration is shared
+@functools.lru_cache(maxsize=None)
+def _get_ocr_client(endpoint: str, key: str) -> ComputerVisionClient:
+    return ComputerVisionClient(endpoint, CognitiveServicesCredentials(key))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_qa_client(endpoint: str, key: str) -> QuestionAnsweringClient:
+    return QuestionAnsweringClient(endpoint, AzureKeyCredential(key))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_openai_client(endpoint: str, key: str) -> AzureOpenAI:
+    return AzureOpenAI(api_key=key, api_version="2024-02-01", azure_endpoint=endpoint)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_search_client(endpoint: str, index_name: str, key: str) -> SearchClient:
+    return SearchClient(endpoint, index_name, AzureKeyCredential(key))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_container_client(connection_string: str, container_name: str) -> ContainerClient:
+    return BlobServiceClient.from_connection_string(connection_string).get_container_client(container_name)
+
 
 def question_ocr(xml: str) -> str:
     """
@@ -36,22 +94,31 @@ def question_ocr(xml: str) -> str:
     Returns:
         str: A concatenated string of all extracted text from the images in the XML.
     """
-    computervision_client = ComputerVisionClient(
-        os.getenv('OCR_ENDPOINT'), 
-        CognitiveServicesCredentials(os.getenv('OCR_KEY'))
-    )
     root = ET.fromstring(xml)
     image_links = [image.get('src') for image in root.iter('image')]
-    extracted_text = []
+    if not image_links:
+        return ""
+    computervision_client = _get_ocr_client(os.getenv('OCR_ENDPOINT'), os.getenv('OCR_KEY'))
 
+    # Submit every image before polling, so the service reads them concurrently instead of one after another
+    operation_ids = []
     for img_link in image_links:
         read_response = computervision_client.read(img_link, raw=True)
-        operation_id = read_response.headers["Operation-Location"].split("/")[-1]
-        while True:
-            read_result = computervision_client.get_read_result(operation_id)
+        operation_ids.append(read_response.headers["Operation-Location"].split("/")[-1])
+
+    read_results = [None] * len(operation_ids)
+    pending = set(range(len(operation_ids)))
+    while pending:
+        for i in sorted(pending):
+            read_result = computervision_client.get_read_result(operation_ids[i])
             if read_result.status not in ['notStarted', 'running']:
-                break
+                read_results[i] = read_result
+                pending.discard(i)
+        if pending:
             time.sleep(1)
+
+    extracted_text = []
+    for read_result in read_results:
         if read_result.status == OperationStatusCodes.succeeded:
             for text_result in read_result.analyze_result.read_results:
                 extracted_text.extend(line.text for line in text_result.lines)
@@ -85,10 +152,12 @@ def ocr_process_input(thread_title: str, conversation_history: List[Dict[str, An
 def process_conversation_search(processed_conversation: List[Dict[str, Any]], prompt_summarize: List[Dict[str, Any]]) -> str:
     """
     Process a conversation and return a summary along with the last message's context and text.
+    The summary goes through the `generate` cache, so requests whose earlier turns match a recent one reuse it.
 
     Args:
         processed_conversation (List[Dict[str, Any]]): A list of messages in the conversation.
-        prompt_summarize (List[Dict[str, Any]]): A prompt for summarizing the conversation.
+        prompt_summarize (List[Dict[str, Any]]): A prompt for summarizing the conversation. Only used, and may be
+            None, when there is more than one message.
 
     Returns:
         str: A string containing the summarized conversation followed by the context and text of the last message.
@@ -102,18 +171,36 @@ def process_conversation_search(processed_conversation: List[Dict[str, Any]], pr
         return f"{last_message['image_context']}{last_message['text']}"
 
 
-def generate(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95) -> str:
+def _generate_cache_key(prompt: List[Dict[str, str]], temperature: float, top_p: float,
+                        response_format: Dict[str, str] = None) -> str:
+    canonical = json.dumps([prompt, temperature, top_p, response_format], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def generate(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95, no_cache: bool = False,
+             response_format: Dict[str, str] = None) -> str:
     """
     Send a prompt to an API endpoint of an LLM and retrieve a response.
+    Responses are cached by prompt and sampling parameters, so repeated prompts skip the API call.
 
     Args:
         prompt (List[Dict[str, str]]): A list of message dictionaries representing the conversation history.
         temperature (float, optional): The sampling temperature for the model's output. Defaults to 0.7.
         top_p (float, optional): The cumulative probability cutoff for top-p sampling. Defaults to 0.95.
+        no_cache (bool, optional): Whether to bypass the response cache. Defaults to False.
+        response_format (Dict[str, str], optional): Constrains the output format, e.g. {"type": "json_object"}. Defaults to None.
 
     Returns:
         str: The content of the response message from the API.
     """
+    cache_key = None
+    if not no_cache:
+        cache_key = _generate_cache_key(prompt, temperature, top_p, response_format)
+        with _GENERATE_CACHE_LOCK:
+            cached = _GENERATE_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
     headers = {
         "Content-Type": "application/json",
         "api-key": os.getenv('OPENAI_KEY')
@@ -123,9 +210,68 @@ def generate(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: floa
         "temperature": temperature,
         "top_p": top_p,
     }
-    response = requests.post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload)
+    if response_format is not None:
+        payload["response_format"] = response_format
+    response = _HTTP.post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload)
     response.raise_for_status()
-    return response.json()['choices'][0]['message']['content']
+    content = response.json()['choices'][0]['message']['content']
+    if cache_key is not None:
+        with _GENERATE_CACHE_LOCK:
+            _GENERATE_CACHE[cache_key] = content
+    return content
+
+
+def generate_stream(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95) -> Iterator[str]:
+    """
+    Send a prompt to an API endpoint of an LLM and yield the response as it is generated.
+    The full response is added to the `generate` cache once the stream completes with [DONE] and non-empty content.
+
+    Args:
+        prompt (List[Dict[str, str]]): A list of message dictionaries representing the conversation history.
+        temperature (float, optional): The sampling temperature for the model's output. Defaults to 0.7.
+        top_p (float, optional): The cumulative probability cutoff for top-p sampling. Defaults to 0.95.
+
+    Yields:
+        str: Consecutive pieces of the content of the response message.
+    """
+    cache_key = _generate_cache_key(prompt, temperature, top_p)
+    with _GENERATE_CACHE_LOCK:
+        cached = _GENERATE_CACHE.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv('OPENAI_KEY')
+    }
+    payload = {
+        "messages": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "stream": True,
+    }
+    pieces = []
+    completed = False
+    with _HTTP.stream('POST', os.getenv('LLM_ENDPOINT'), headers=headers, json=payload) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                completed = True
+                break
+            choices = json.loads(data).get('choices')
+            # Azure sends content filter results as chunks without choices or content
+            piece = choices[0].get('delta', {}).get('content') if choices else None
+            if piece:
+                pieces.append(piece)
+                yield piece
+    # A filtered or cut-off stream must not leave an empty or partial answer in the cache
+    if completed and pieces:
+        with _GENERATE_CACHE_LOCK:
+            _GENERATE_CACHE[cache_key] = ''.join(pieces)
 
 
 def retrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.08) -> str:
@@ -140,10 +286,7 @@ def retrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.0
     Returns:
         str: A formatted string containing the top matching question-answer pairs retrieved from the service.
     """
-    client = QuestionAnsweringClient(
-        os.getenv('QA_ENDPOINT'), 
-        AzureKeyCredential(os.getenv('QA_KEY'))
-    )
+    client = _get_qa_client(os.getenv('QA_ENDPOINT'), os.getenv('QA_KEY'))
     output = client.get_answers(
         question=conversation[-4999:],  # the limit is 5000 chars
         top=top_k,
@@ -165,6 +308,7 @@ def retrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.0
 def embed_text(text: str, model_name: str) -> List[float]:
     """
     Generate an embedding for a given text using a specified model via Azure OpenAI.
+    Embeddings are cached by model and text, so repeated texts skip the API call.
 
     Args:
         text (str): The input text to generate the embedding for.
@@ -173,16 +317,37 @@ def embed_text(text: str, model_name: str) -> List[float]:
     Returns:
         List[float]: A list representing the embedding vector for the input text.
     """
-    client = AzureOpenAI(
-        api_key=os.getenv("OPENAI_KEY"),  
-        api_version="2024-02-01",
-        azure_endpoint=os.getenv("OPENAI_ENDPOINT")
-    )
-    response = client.embeddings.create(input=text, model=model_name)
-    return response.data[0].embedding
+    return embed_texts([text], model_name=model_name)[0]
 
 
-def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_reranking: bool) -> str:
+def embed_texts(texts: List[str], model_name: str) -> List[List[float]]:
+    """
+    Generate embeddings for several texts with a single Azure OpenAI call.
+    Embeddings are cached by model and text; only texts missing from the cache are sent.
+
+    Args:
+        texts (List[str]): The input texts to generate embeddings for.
+        model_name (str): The name of the model to use for generating the embeddings.
+
+    Returns:
+        List[List[float]]: The embedding vectors, in the order of texts.
+    """
+    with _EMBED_CACHE_LOCK:
+        embeddings = [_EMBED_CACHE.get((model_name, text)) for text in texts]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        client = _get_openai_client(os.getenv("OPENAI_ENDPOINT"), os.getenv("OPENAI_KEY"))
+        response = client.embeddings.create(input=missing, model=model_name)
+        fetched = {text: item.embedding for text, item in zip(missing, sorted(response.data, key=lambda d: d.index))}
+        with _EMBED_CACHE_LOCK:
+            for text, embedding in fetched.items():
+                _EMBED_CACHE[(model_name, text)] = embedding
+        embeddings = [embedding if embedding is not None else fetched[text] for text, embedding in zip(texts, embeddings)]
+    return embeddings
+
+
+def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_reranking: bool,
+                         embedding: List[float] = None, fast: bool = False) -> str:
     """
     Retrieve documents using a hybrid search combining text and vector queries.
 
@@ -191,18 +356,16 @@ def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_rerank
         index_name (str): The name of the search index.
         top_k (int): The number of top documents to retrieve.
         semantic_reranking (bool): Whether to use semantic reranking.
+        embedding (List[float], optional): A precomputed embedding of text. Computed here if not provided.
+        fast (bool, optional): Skip semantic reranking and keep the first-stage hybrid ranking. Defaults to False.
 
     Returns:
         str: The retrieved documents or an empty string if an error occurs.
     """
     try:
-        search_client = SearchClient(
-            os.getenv("SEARCH_ENDPOINT"), 
-            index_name, 
-            AzureKeyCredential(os.getenv("SEARCH_KEY"))
-        )
+        search_client = _get_search_client(os.getenv("SEARCH_ENDPOINT"), index_name, os.getenv("SEARCH_KEY"))
         vector_query = VectorizedQuery(
-            vector=embed_text(text, model_name=os.getenv("EMBEDDING_MODEL_NAME")),
+            vector=embedding or embed_text(text, model_name=os.getenv("EMBEDDING_MODEL_NAME")),
             k_nearest_neighbors=top_k,
             fields="vector"
         )
@@ -212,7 +375,7 @@ def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_rerank
             "select": ["content"],
             "top": top_k
         }
-        if semantic_reranking:
+        if semantic_reranking and not fast:
             search_params.update({
                 "query_type": "semantic",
                 "semantic_query": text,
@@ -238,8 +401,8 @@ def get_file_names_dir(directory_path: str) -> List[str]:
     Returns:
         List[str]: A list of file names found in the specified directory.
     """
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-    container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+    container_client = _get_container_client(os.getenv('AZURE_STORAGE_CONNECTION_STRING'),
+                                             os.getenv('AZURE_BLOB_CONTAINER_NAME'))
     blobs_list = container_client.list_blobs(name_starts_with=directory_path)
     return ['/'.join(Path(blob.name).parts[2:]) for blob in blobs_list]
 
@@ -266,12 +429,16 @@ def retrieve_docs_manual(question_category: str, category_mapping: dict, questio
         problem_paths_list = get_file_names_dir(f'docs_manual/{subcategory_mapping[question_subcategory]}')
 
     prompt = get_prompt(paths='\n'.join(problem_paths_list),
-                        question_info=re.sub(pattern=r"\n+", repl=" ", string=question_info))
+                        question_info=_NL_RE.sub(" ", question_info))
     processed_question = generate(prompt=prompt)
     
     retrieved_docs = 'none'
     try:
-        processed_question = ast.literal_eval(processed_question)
+        try:
+            processed_question = orjson.loads(processed_question)
+        except orjson.JSONDecodeError:
+            # The prompt asks for JSON, but the model occasionally answers with a Python dict literal
+            processed_question = ast.literal_eval(processed_question)
         selected_path = processed_question['selected_path']
     except Exception as e:
         logger.error(f"Error processing question: {e}")
@@ -285,8 +452,8 @@ def retrieve_docs_manual(question_category: str, category_mapping: dict, questio
             
     if selected_path != 'none':
         try:
-            blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-            container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+            container_client = _get_container_client(os.getenv('AZURE_STORAGE_CONNECTION_STRING'),
+                                                     os.getenv('AZURE_BLOB_CONTAINER_NAME'))
             if question_category in category_mapping:
                 blob_path = f'docs_manual/{category_mapping[question_category]}/{selected_path}'
             elif question_subcategory in subcategory_mapping:
@@ -301,6 +468,293 @@ def retrieve_docs_manual(question_category: str, category_mapping: dict, questio
     return str(problem_paths_list), selected_path, retrieved_docs
 
 
+async def _run_bounded(func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking call in a worker thread, holding a slot of the shared outbound-call limit while it runs.
+
+    Args:
+        func (Callable): The blocking function to call.
+        *args: Positional arguments passed to func.
+        **kwargs: Keyword arguments passed to func.
+
+    Returns:
+        Any: The return value of func.
+    """
+    async with _OUTBOUND_LIMIT:
+        return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def aprocess_conversation_search(processed_conversation: List[Dict[str, Any]], prompt_summarize: List[Dict[str, Any]]) -> str:
+    """Async variant of `process_conversation_search`."""
+    return await _run_bounded(process_conversation_search, processed_conversation=processed_conversation,
+                              prompt_summarize=prompt_summarize)
+
+
+async def agenerate(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95,
+                    no_cache: bool = False, response_format: Dict[str, str] = None) -> str:
+    """Async variant of `generate`."""
+    return await _run_bounded(generate, prompt=prompt, temperature=temperature, top_p=top_p, no_cache=no_cache,
+                              response_format=response_format)
+
+
+async def agenerate_stream(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95) -> AsyncIterator[str]:
+    """
+    Async variant of `generate_stream`; each chunk is read in a worker thread so the event loop never blocks.
+    A slot of the shared outbound-call limit is held for the whole stream.
+    """
+    loop = asyncio.get_running_loop()
+    async with _OUTBOUND_LIMIT:
+        chunks = generate_stream(prompt=prompt, temperature=temperature, top_p=top_p)
+        done = object()
+        while (chunk := await loop.run_in_executor(_EXECUTOR, next, chunks, done)) is not done:
+            yield chunk
+
+
+async def aretrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.08) -> str:
+    """Async variant of `retrieve_qa`."""
+    return await _run_bounded(retrieve_qa, conversation=conversation, top_k=top_k,
+                              confidence_threshold=confidence_threshold)
+
+
+async def aretrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_reranking: bool,
+                                embedding: List[float] = None, fast: bool = False) -> str:
+    """Async variant of `retrieve_docs_hybrid`."""
+    return await _run_bounded(retrieve_docs_hybrid, text=text, index_name=index_name, top_k=top_k,
+                              semantic_reranking=semantic_reranking, embedding=embedding, fast=fast)
+
+
+async def aretrieve_docs_manual(question_category: str, category_mapping: dict, question_subcategory: str, subcategory_mapping: dict, question_info: str, get_prompt: Callable[[List, str], List]) -> tuple:
+    """Async variant of `retrieve_docs_manual`."""
+    return await _run_bounded(retrieve_docs_manual, question_category=question_category,
+                              category_mapping=category_mapping, question_subcategory=question_subcategory,
+                              subcategory_mapping=subcategory_mapping, question_info=question_info,
+                              get_prompt=get_prompt)
+
+
+class BatchedEmbedder:
+    """
+    Coalesces concurrent embedding requests on one event loop into batched embeddings calls.
+
+    The first request of a batch waits up to `max_batch_hold` seconds for others to join; the batch
+    is sent as one `embed_texts` call once it is full or the hold expires.
+
+    Args:
+        model_name (str): The name of the embedding model.
+        max_batch_size (int, optional): The maximum number of texts per call. Defaults to 16.
+        max_batch_hold (float, optional): The longest a request waits for a batch to fill, in seconds. Defaults to 0.01.
+    """
+
+    def __init__(self, model_name: str, max_batch_size: int = 16, max_batch_hold: float = 0.01):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_batch_hold = max_batch_hold
+        self._loop = None  # the queue and its consumer task belong to the loop that first uses them
+        self._queue = None
+        self._consumer = None
+        self._in_flight = set()
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        Embed a text as part of the next batch.
+
+        Args:
+            text (str): The input text to generate the embedding for.
+
+        Returns:
+            List[float]: The embedding vector for the input text.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._queue = loop, asyncio.Queue()
+            self._consumer = loop.create_task(self._consume())
+        future = loop.create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_batch_hold
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # Send the batch without waiting for it, so the next one starts filling right away
+            task = loop.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: List[tuple]) -> None:
+        try:
+            embeddings = await _run_bounded(embed_texts, texts=[text for text, _ in batch], model_name=self.model_name)
+        except Exception as e:
+            if len(batch) > 1:
+                # One bad text (e.g. over the token limit) fails the whole call; retry each text on its own so
+                # only the requests whose input is at fault get the error
+                logger.warning("Batched embedding of %d texts failed, retrying them one by one", len(batch), exc_info=True)
+                await asyncio.gather(*(self._send([item]) for item in batch))
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+
+class SemanticCache:
+    """
+    Approximate in-memory cache keyed by embedding vectors.
+
+    Each embedding is hashed into one bucket per LSH table with random hyperplanes; a lookup
+    only compares against entries sharing a bucket and hits when their cosine similarity
+    reaches the threshold. Entries expire after `ttl` seconds. Live entries can be saved to and
+    loaded from a SQLite file, so a restarted process doesn't start cold; saved namespaces and values
+    must be JSON-serializable (tuples come back as tuples for namespaces, as lists inside values).
+
+    Args:
+        threshold (float, optional): The minimum cosine similarity for a hit. Defaults to 0.95.
+        maxsize (int, optional): The maximum number of buckets kept. Defaults to 10000.
+        ttl (float, optional): The lifetime of an entry in seconds. Defaults to 3600.
+        num_tables (int, optional): The number of LSH tables. Defaults to 4.
+        num_planes (int, optional): The number of hyperplanes per table. Defaults to 8.
+        bucket_size (int, optional): The maximum number of entries kept per bucket. Defaults to 32.
+        dimensions (int, optional): The embedding dimension. Embeddings of any other size are rejected and
+            skipped on load. Defaults to the size of the first embedding used.
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 10000, ttl: float = 3600,
+                 num_tables: int = 4, num_planes: int = 8, bucket_size: int = 32, dimensions: int = None):
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.ttl = ttl
+        self.num_tables = num_tables
+        self.num_planes = num_planes
+        self.bucket_size = bucket_size
+        self._planes = None  # created on first use, once the embedding dimension is known
+        self._buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _keys(self, vector: np.ndarray, namespace: Any) -> List[tuple]:
+        if self._planes is None:
+            rng = np.random.default_rng(0)
+            self._planes = rng.standard_normal((self.num_tables, self.num_planes, self.dimensions or vector.shape[0]))
+        if vector.shape[0] != self._planes.shape[2]:
+            raise ValueError(f"expected a {self._planes.shape[2]}-dimensional embedding, got {vector.shape[0]}")
+        bits = self._planes @ vector > 0
+        return [(namespace, table, np.packbits(table_bits).tobytes()) for table, table_bits in enumerate(bits)]
+
+    def get(self, embedding: List[float], namespace: Any = None) -> Any:
+        """
+        Look up the value stored for the most similar embedding.
+
+        Args:
+            embedding (List[float]): The query embedding.
+            namespace (Any, optional): Restricts the lookup to entries stored under the same namespace.
+
+        Returns:
+            Any: The cached value, or None on a miss.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        now = time.monotonic()
+        best_value, best_similarity = None, self.threshold
+        with self._lock:
+            for key in self._keys(vector, namespace):
+                for expires_at, cached_vector, value in self._buckets.get(key, ()):
+                    if expires_at > now:
+                        similarity = float(cached_vector @ vector)
+                        if similarity >= best_similarity:
+                            best_value, best_similarity = value, similarity
+        return best_value
+
+    def put(self, embedding: List[float], value: Any, namespace: Any = None) -> None:
+        """
+        Store a value under an embedding.
+
+        Args:
+            embedding (List[float]): The embedding to key the value by.
+            value (Any): The value to cache.
+            namespace (Any, optional): The namespace to store the entry under.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        now = time.monotonic()
+        with self._lock:
+            self._insert(vector, value, namespace, now + self.ttl, now)
+
+    def _insert(self, vector: np.ndarray, value: Any, namespace: Any, expires_at: float, now: float) -> None:
+        entry = (expires_at, vector, value)
+        for key in self._keys(vector, namespace):
+            entries = [e for e in self._buckets.get(key, ()) if e[0] > now][-(self.bucket_size - 1):]
+            self._buckets[key] = entries + [entry]
+
+    def save(self, path: str) -> int:
+        """
+        Write the live entries to a SQLite file. Entries already in the file (e.g. saved by other
+        worker processes) are kept unless they have expired.
+
+        Args:
+            path (str): The path of the SQLite file.
+
+        Returns:
+            int: The number of entries written.
+        """
+        now, wall_now = time.monotonic(), time.time()
+        with self._lock:
+            # An entry is stored in one bucket per table; save it once
+            live = {id(entry): (namespace, entry)
+                    for (namespace, _, _), entries in list(self._buckets.items())
+                    for entry in entries if entry[0] > now}
+        rows = []
+        for namespace, (expires_at, vector, value) in live.values():
+            namespace_blob, vector_blob = orjson.dumps(namespace), vector.tobytes()
+            rows.append((hashlib.blake2b(namespace_blob + vector_blob, digest_size=16).digest(),
+                         namespace_blob, vector_blob, orjson.dumps(value), wall_now + expires_at - now))
+        with closing(sqlite3.connect(path)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS semantic_cache "
+                         "(key BLOB PRIMARY KEY, namespace BLOB, vector BLOB, value BLOB, expires_at REAL)")
+            conn.execute("DELETE FROM semantic_cache WHERE expires_at <= ?", (wall_now,))
+            conn.executemany("INSERT OR REPLACE INTO semantic_cache VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def load(self, path: str) -> int:
+        """
+        Add the unexpired entries of a SQLite file written by `save`, keeping their remaining lifetime.
+
+        Args:
+            path (str): The path of the SQLite file.
+
+        Returns:
+            int: The number of entries loaded, 0 if the file doesn't exist yet.
+        """
+        if not os.path.exists(path):
+            return 0
+        now, wall_now = time.monotonic(), time.time()
+        with closing(sqlite3.connect(path)) as conn:
+            try:
+                rows = conn.execute("SELECT namespace, vector, value, expires_at FROM semantic_cache WHERE expires_at > ?",
+                                    (wall_now,)).fetchall()
+            except sqlite3.OperationalError:
+                return 0
+        loaded = 0
+        with self._lock:
+            dimensions = self.dimensions or (self._planes.shape[2] if self._planes is not None else None)
+            for namespace_blob, vector_blob, value_blob, expires_at in rows:
+                vector = np.frombuffer(vector_blob, dtype=np.float32).copy()
+                if dimensions is not None and vector.shape[0] != dimensions:
+                    continue  # saved with a different embedding model
+                namespace = orjson.loads(namespace_blob)
+                if isinstance(namespace, list):
+                    namespace = tuple(namespace)
+                self._insert(vector, orjson.loads(value_blob), namespace, now + expires_at - wall_now, now)
+                loaded += 1
+        return loaded
+
+
 def log_local(log_dict: Dict[str, Any], file_path: str) -> None:
     """
     Save a log entry by combining input and output dictionaries and appending it to a file.
@@ -325,8 +779,8 @@ def log_blob(log_dict: Dict[str, Any], blob_name: str) -> None:
         blob_name (str): The name of the blob file where the log entry will be saved.
     """
     log_dict['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-    container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+    container_client = _get_container_client(os.getenv('AZURE_STORAGE_CONNECTION_STRING'),
+                                             os.getenv('AZURE_BLOB_CONTAINER_NAME'))
     if not container_client.exists():
         container_client.create_container()
     blob_client = container_client.get_blob_client(blob=blob_name)